@@ -9,12 +9,18 @@ Authors:
 """
 
 import os
+import csv
 import json
 import shutil
 import random
 import logging
+import functools
+import numpy as np
+import torchaudio
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.contrib import tqdm
-from speechbrain.utils.data_utils import get_all_files, download_file
+from speechbrain.utils.data_utils import download_file
 from speechbrain.dataio.dataio import read_audio
 
 logger = logging.getLogger(__name__)
@@ -54,40 +60,85 @@ def prepare_mini_librispeech(
     >>> prepare_mini_librispeech(data_folder, 'train.json', 'valid.json', 'test.json')
     """
 
-    # Check if this phase is already done (if so, skip it)
-    if skip(save_json_train, save_json_valid, save_json_test):
+    # Check if this phase is already done, and the corpus did not change
+    # since then (if so, skip it)
+    corpus_folder = os.path.join(data_folder, "LibriSpeech")
+    meta_data = os.path.join(corpus_folder, "SPEAKERS.TXT")
+    sources = [meta_data] + [
+        os.path.join(corpus_folder, split) for split in ["train", "val", "test"]
+    ]
+    if skip(save_json_train, save_json_valid, save_json_test, sources=sources):
         logger.info("Preparation completed in previous run, skipping.")
         return
 
-    gender_dict = {}
-    meta_data = os.path.join(data_folder, "LibriSpeech", "SPEAKERS.TXT")
+    # Reading the speaker-id to gender mapping (comment lines start with ";")
     with open(meta_data) as fa:
-        for line in fa.readlines():
-            line = line.strip()
-            if line[0].isdigit():
-                tt = line.split('|')
-                index = tt[0].strip()
-                gender = tt[1].strip()
-                gender_dict[index] = gender
-
-    # If the dataset doesn't exist yet, download it
-    train_folder = os.path.join(data_folder, "LibriSpeech", "train")
-    val_folder = os.path.join(data_folder, "LibriSpeech", "val")
-    test_folder = os.path.join(data_folder, "LibriSpeech", "test")
-
-    # List files and create manifest from list
+        rows = (
+            [field.strip() for field in row]
+            for row in csv.reader(fa, delimiter="|", quoting=csv.QUOTE_NONE)
+        )
+        gender_dict = {
+            row[0]: row[1] for row in rows if row and row[0][:1].isdigit()
+        }
+
+    # List files (train, val, and test in a single traversal)
     logger.info(
         f"Creating {save_json_train}, {save_json_valid}, and {save_json_test}"
     )
-    extension = [".flac"]
-    train_wav_list = get_all_files(train_folder, match_and=extension)
-    val_wav_list = get_all_files(val_folder, match_and=extension)
-    test_wav_list = get_all_files(test_folder, match_and=extension)
+    wav_lists = _split_walk(corpus_folder)
 
     # Creating json files
-    create_json(train_wav_list, save_json_train, gender_dict)
-    create_json(val_wav_list, save_json_valid, gender_dict)
-    create_json(test_wav_list, save_json_test, gender_dict)
+    create_json(wav_lists["train"], save_json_train, gender_dict)
+    create_json(wav_lists["val"], save_json_valid, gender_dict)
+    create_json(wav_lists["test"], save_json_test, gender_dict)
+
+
+def _split_walk(root, splits=("train", "val", "test"), extension=".flac"):
+    """
+    Lists the audio files of all the splits with a single walk of `root`.
+
+    Arguments
+    ---------
+    root : str
+        Folder containing one sub-folder per split.
+    splits : tuple of str
+        Names of the split sub-folders.
+    extension : str
+        Only files ending with this extension are listed.
+
+    Returns
+    -------
+    dict
+        Mapping from each split name to its list of files.
+
+    Raises
+    ------
+    OSError
+        If one of the splits has no files (or its folder does not exist).
+    """
+    # Split folders are often assembled from symlinks, which must be followed
+    wav_lists = {split: [] for split in splits}
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        rel_parts = os.path.relpath(dirpath, root).split(os.sep)
+
+        # Only descend into the split folders
+        if rel_parts == [os.curdir]:
+            dirnames[:] = [d for d in dirnames if d in wav_lists]
+            continue
+
+        wav_lists[rel_parts[0]].extend(
+            os.path.join(dirpath, f) for f in filenames if f.endswith(extension)
+        )
+
+    # Checking that all the splits were found
+    for split, wav_list in wav_lists.items():
+        if not wav_list:
+            err_msg = "no %s files found in the folder %s" % (
+                extension,
+                os.path.join(root, split),
+            )
+            raise OSError(err_msg)
+    return wav_lists
 
 
 def create_json(wav_list, json_file, gender_dict):
@@ -100,43 +151,174 @@ def create_json(wav_list, json_file, gender_dict):
         The list of wav files.
     json_file : str
         The path of the output json file
+    gender_dict : dict
+        Mapping from speaker-id to gender.
     """
-    # Processing all the wav files in the list
-    json_dict = {}
-    for wav_file in tqdm(wav_list, dynamic_ncols=True):
-
-        # Reading the signal (to retrieve duration in seconds)
-        signal = read_audio(wav_file)
-        duration = signal.shape[0] / SAMPLERATE
-
-        # Manipulate path to get relative path and uttid
-        path_parts = wav_file.split(os.path.sep)
-        uttid, _ = os.path.splitext(path_parts[-1])
-        relative_path = os.path.join("{data_root}", *path_parts[-5:])
-
-        # Getting speaker-id from utterance-id
-        spk_id = uttid.split("-")[0]
-
-        # Create entry for this utterance
-        json_dict[uttid] = {
-            "wav": relative_path,
-            "duration": duration,
-            "spk_id": spk_id,
-            "gender_id": gender_dict[spk_id],
-        }
-
-    # Writing the dictionary to the json file
-    with open(json_file, mode="w") as json_f:
-        json.dump(json_dict, json_f, indent=2)
+    # Processing all the wav files in the list (in parallel), and streaming
+    # each entry to the json file as soon as it is ready
+    probe = functools.partial(_probe, gender_dict=gender_dict)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        entries = tqdm(
+            pool.map(probe, wav_list, chunksize=64),
+            total=len(wav_list),
+            dynamic_ncols=True,
+        )
+        _write_json(entries, json_file)
 
     logger.info(f"{json_file} successfully created!")
 
 
-def skip(*filenames):
+def _write_json(entries, json_file):
+    """
+    Writes a json manifest one entry per line, as the entries are produced.
+    They are written to a temporary file first, which replaces `json_file`
+    only once all of them are written, so that an interrupted run never
+    leaves a truncated manifest behind.
+
+    Arguments
+    ---------
+    entries : iterable of tuple
+        The utterance-ids and their json entries.
+    json_file : str
+        The path of the output json file.
+    """
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, mode="w") as json_f:
+        json_f.write("{")
+        separator = "\n  "
+        for uttid, entry in entries:
+            json_f.write(f"{separator}{json.dumps(uttid)}: ")
+            json.dump(entry, json_f)
+            separator = ",\n  "
+        json_f.write("\n}\n")
+    os.replace(tmp_file, json_file)
+
+
+def _probe(wav_file, gender_dict):
+    """
+    Creates the manifest entry of a single wav file.
+
+    Arguments
+    ---------
+    wav_file : str
+        The path of the wav file.
+    gender_dict : dict
+        Mapping from speaker-id to gender.
+
+    Returns
+    -------
+    tuple
+        The utterance-id and its json entry.
+    """
+    # Reading the header only (to retrieve duration in seconds)
+    info = torchaudio.info(wav_file)
+    assert info.sample_rate == SAMPLERATE
+    duration = info.num_frames / info.sample_rate
+
+    # Manipulate path to get relative path and uttid
+    wav_path = PurePath(wav_file)
+    uttid = wav_path.stem
+    relative_path = "/".join(("{data_root}",) + wav_path.parts[-5:])
+
+    # Getting speaker-id from utterance-id
+    spk_id = uttid.split("-", 1)[0]
+
+    # Create entry for this utterance
+    entry = {
+        "wav": relative_path,
+        "duration": duration,
+        "spk_id": spk_id,
+        "gender_id": gender_dict[spk_id],
+    }
+
+    return uttid, entry
+
+
+def create_memmap(json_files, memmap_json_files, memmap_file, data_folder):
+    """
+    Decodes all the audio files listed in the json files into a single int16
+    array, saved as a .npy file that can be memory-mapped. The json files are
+    copied with the "offset" and "length" (in samples) of each utterance in
+    this array added to its entry, so that the signals can be sliced from the
+    array instead of decoding the FLAC files at every epoch.
+
+    Arguments
+    ---------
+    json_files : list of str
+        The json files, as created by `create_json` (they are only read).
+    memmap_json_files : list of str
+        Paths where the copies of the json files will be saved.
+    memmap_file : str
+        Path where the .npy file will be saved.
+    data_folder : str
+        Path replacing "{data_root}" in the wav paths of the json files.
+
+    Example
+    -------
+    >>> create_memmap(
+    ...     ['train.json'], ['train_memmap.json'], 'audio.npy', '/path/to/data'
+    ... )
+    """
+
+    # Check if this phase is already done (if so, skip it)
+    if skip(memmap_file, *memmap_json_files, sources=json_files):
+        logger.info(f"{memmap_file} created in previous run, skipping.")
+        return
+
+    # Locating each utterance in the array
+    json_dicts = []
+    total_length = 0
+    for json_file in json_files:
+        with open(json_file) as json_f:
+            json_dict = json.load(json_f)
+        for entry in json_dict.values():
+            entry["offset"] = total_length
+            entry["length"] = round(entry["duration"] * SAMPLERATE)
+            total_length += entry["length"]
+        json_dicts.append(json_dict)
+
+    # Decoding the signals into the array. It is written to a temporary
+    # file first, so that an interrupted run is not skipped next time.
+    logger.info(f"Creating {memmap_file}")
+    tmp_file = memmap_file + ".tmp"
+    memmap = np.lib.format.open_memmap(
+        tmp_file, mode="w+", dtype=np.int16, shape=(total_length,)
+    )
+    for json_dict in json_dicts:
+        for entry in tqdm(json_dict.values(), dynamic_ncols=True):
+            signal = read_audio(entry["wav"].format(data_root=data_folder))
+            assert len(signal) == entry["length"]
+            signal = (signal * 32768).round().clamp(-32768, 32767)
+            memmap[
+                entry["offset"] : entry["offset"] + entry["length"]
+            ] = signal.short().numpy()
+    memmap.flush()
+    del memmap
+
+    # Writing the json files with the offsets
+    for json_file, json_dict in zip(memmap_json_files, json_dicts):
+        _write_json(json_dict.items(), json_file)
+
+    # The array is moved in place last, and marked as newer than the json
+    # files that were just written
+    os.replace(tmp_file, memmap_file)
+    os.utime(memmap_file)
+    logger.info(f"{memmap_file} successfully created!")
+
+
+def skip(*filenames, sources=()):
     """
     Detects if the data preparation has been already done.
     If the preparation has been done, we can skip it.
 
+    Arguments
+    ---------
+    *filenames : str
+        The files created by the preparation.
+    sources : list of str
+        The files or folders read by the preparation. If any of them was
+        modified after one of the created files, it must be done again.
+
     Returns
     -------
     bool
@@ -146,14 +328,15 @@ def skip(*filenames):
     for filename in filenames:
         if not os.path.isfile(filename):
             return False
-    return True
 
-
-def check_folders(*folders):
-    """Returns False if any passed folder does not exist."""
-    for folder in folders:
-        if not os.path.exists(folder):
-            return False
+    source_mtimes = [
+        os.path.getmtime(source) for source in sources if os.path.exists(source)
+    ]
+    if source_mtimes:
+        latest_source = max(source_mtimes)
+        for filename in filenames:
+            if os.path.getmtime(filename) < latest_source:
+                return False
     return True
 
 
@@ -26,6 +26,8 @@ Authors
 """
 import os
 import sys
+import shutil
+import tempfile
 import numpy as np
 import random
 import torch
@@ -33,10 +35,21 @@ import torchaudio
 import speechbrain as sb
 import scipy.io.wavfile as sciwav
 from hyperpyyaml import load_hyperpyyaml
+from concurrent.futures import ThreadPoolExecutor
+from speechbrain.utils.checkpoints import Checkpointer, ckpt_recency
+from speechbrain.dataio.sampler import DynamicBatchSampler
+from gender_librispeech_prepare import create_memmap
 
 
 # Brain class for speech enhancement training
 class SpkIdBrain(sb.Brain):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Background thread moving the checkpoints to their final folder
+        self.ckpt_pool = ThreadPoolExecutor(max_workers=1)
+        self.ckpt_future = None
+
     def compute_forward(self, batch, stage):
         """Runs all the computation of that transforms the input into the
         output probabilities over the N classes.
@@ -55,10 +68,12 @@ class SpkIdBrain(sb.Brain):
         """
 
         # We first move the batch to the appropriate device.
-        batch = batch.to(self.device)
+        batch = batch.to(self.device, non_blocking=True)
 
-        # Compute features, embeddings, and predictions
-        feats, lens = self.prepare_features(batch.sig, stage)
+        # Compute features, embeddings, and predictions. Augmentation and
+        # features are kept in full precision, also with auto_mix_prec.
+        with torch.cuda.amp.autocast(enabled=False):
+            feats, lens = self.prepare_features(batch.sig, stage)
 #        print(feats.shape)
         embeddings = self.modules.embedding_model(feats, lens)
         predictions = self.modules.classifier(embeddings)
@@ -68,6 +83,11 @@ class SpkIdBrain(sb.Brain):
     def prepare_features(self, wavs, stage):
         """Prepare the features for computation, including augmentation.
 
+        Both run on the whole padded batch, on ``self.device``:
+        ``compute_features`` is one of the Brain modules, and the batch is
+        moved to the device before calling this method. The dataloader
+        workers thus only have to read the audio.
+
         Arguments
         ---------
         wavs : tuple
@@ -76,15 +96,14 @@ class SpkIdBrain(sb.Brain):
             The current stage of training.
         """
         wavs, lens = wavs
+        wavs_aug_tot = [wavs]
 
         # Add augmentation if specified. In this version of augmentation, we
-        # concatenate the original and the augment batches in a single bigger
-        # batch. This is more memory-demanding, but helps to improve the
-        # performance. Change it if you run OOM.
+        # concatenate the features of the original and the augment batches in
+        # a single bigger batch. This is more memory-demanding, but helps to
+        # improve the performance. Change it if you run OOM.
         if stage == sb.Stage.TRAIN:
         # Applying the augmentation pipeline
-            wavs_aug_tot = []
-            wavs_aug_tot.append(wavs)
             for count, augment in enumerate(self.hparams.augment_pipeline):
 
                 # Apply augment
@@ -104,14 +123,22 @@ class SpkIdBrain(sb.Brain):
                     wavs = wavs_aug
                     wavs_aug_tot[0] = wavs
 
-            wavs = torch.cat(wavs_aug_tot, dim=0)
             self.n_augment = len(wavs_aug_tot)
-            lens = torch.cat([lens] * self.n_augment)
 
 #        print(wavs.shape, lens.shape)
-        # Feature extraction and normalization
-        feats = self.modules.compute_features(wavs)
-        feats = self.modules.mean_var_norm(feats, lens)
+        # Feature extraction and normalization. Each copy of the batch goes
+        # through the feature extractor on its own, so that its intermediate
+        # buffers are never allocated for all the copies at once.
+        feats = torch.cat(
+            [
+                self.modules.mean_var_norm(
+                    self.modules.compute_features(wavs_aug), lens
+                )
+                for wavs_aug in wavs_aug_tot
+            ],
+            dim=0,
+        )
+        lens = torch.cat([lens] * len(wavs_aug_tot))
 
         return feats, lens
 
@@ -133,28 +160,30 @@ class SpkIdBrain(sb.Brain):
             A one-element tensor used for backpropagating the gradient.
         """
 
-        _, lens = batch.sig
-        spkid, _ = batch.gender_id_encoded
+        # Labels are collated to a [batch] tensor, match predictions [batch, 1]
+        spkid = batch.gender_id_encoded.unsqueeze(1)
 
 
         # Concatenate labels (due to data augmentation)
         if stage == sb.Stage.TRAIN:
             spkid = torch.cat([spkid] * self.n_augment, dim=0)
-            lens = torch.cat([lens] * self.n_augment)
 
         # Compute the cost function
 #        loss = sb.nnet.losses.nll_loss(predictions, spkid, lens)
         predictions = predictions.squeeze(-1)
 #        print(predictions.shape, spkid.shape, lens.shape)
         
-        loss = self.hparams.compute_BCE_cost(predictions, spkid, lens)
+        # There is one logit per utterance (the embeddings are pooled over
+        # time), so no length mask is needed
+        loss = self.hparams.compute_BCE_cost(predictions, spkid)
     
 
-        self.train_metrics.append(batch.id, torch.sigmoid(predictions), spkid)
+        # The loss works on the logits (bce_loss uses the fused
+        # binary_cross_entropy_with_logits), the metrics on the probabilities
+        probs = torch.sigmoid(predictions.detach())
+        self.train_metrics.append(batch.id, probs, spkid)
         if stage != sb.Stage.TRAIN:
-            self.valid_metrics.append(
-                batch.id, torch.sigmoid(predictions), spkid
-            )
+            self.valid_metrics.append(batch.id, probs, spkid)
 
         # Append this batch of losses to the loss metric for easy
 #        self.loss_metric.append(
@@ -238,7 +267,7 @@ class SpkIdBrain(sb.Brain):
 
             # Save the current checkpoint and delete previous checkpoints,
 #            self.checkpointer.save_and_keep_only(meta=stats, min_keys=["error"])
-            self.checkpointer.save_and_keep_only(
+            self.save_checkpoint_async(
                 meta={"loss": stage_loss, "summary": summary},
                 num_to_keep=1,
                 min_keys=["loss"],
@@ -253,6 +282,77 @@ class SpkIdBrain(sb.Brain):
 #                test_stats=stats,
             )
 
+    def save_checkpoint_async(self, meta, name, num_to_keep=1, min_keys=[]):
+        """Saves a checkpoint without blocking training on slow storage.
+
+        The checkpoint is first written to a local temporary folder, so that
+        it holds the current state even if training goes on. A background
+        thread then moves it to the checkpoints folder and deletes the
+        checkpoints that are not worth keeping, as `save_and_keep_only` does.
+
+        Arguments
+        ---------
+        meta : mapping
+            A mapping which is added to the meta file in the checkpoint.
+        name : str
+            The name of the checkpoint.
+        num_to_keep : int
+            Number of checkpoints to keep.
+        min_keys : list
+            A list of keys for which the *lowest* value will be kept.
+        """
+        self.wait_for_checkpoint()
+        staging = Checkpointer(
+            tempfile.mkdtemp(),
+            recoverables=self.checkpointer.recoverables,
+            custom_save_hooks=self.checkpointer.custom_save_hooks,
+        )
+        ckpt = staging.save_checkpoint(meta=meta, name=name)
+        self.ckpt_future = self.ckpt_pool.submit(
+            self._publish_checkpoint, ckpt, num_to_keep, min_keys
+        )
+
+    def _publish_checkpoint(self, ckpt, num_to_keep, min_keys):
+        """Moves a checkpoint saved by `save_checkpoint_async` to the
+        checkpoints folder, then deletes the least important checkpoints.
+        The checkpoint is copied under a temporary name first, so that an
+        incomplete copy is never taken for a checkpoint (the leftover of an
+        interrupted copy is removed)."""
+        checkpoints_dir = self.checkpointer.checkpoints_dir
+        tmp_dir = checkpoints_dir / f"tmp+{ckpt.path.name}"
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        shutil.copytree(ckpt.path, tmp_dir)
+        os.rename(tmp_dir, checkpoints_dir / ckpt.path.name)
+        shutil.rmtree(ckpt.path.parent)
+
+        self.checkpointer.delete_checkpoints(
+            num_to_keep=num_to_keep,
+            min_keys=min_keys,
+            importance_keys=[ckpt_recency],
+        )
+
+    def wait_for_checkpoint(self):
+        """Waits until the last checkpoint is in the checkpoints folder
+        (and raises the error of its background thread, if any)."""
+        if self.ckpt_future is not None:
+            self.ckpt_future.result()
+            self.ckpt_future = None
+
+    def _save_intra_epoch_ckpt(self):
+        """Waits for the last checkpoint before saving an intra-epoch one.
+        This only runs on the main process, which `fit()` already follows
+        with a DDP barrier."""
+        self.wait_for_checkpoint()
+        super()._save_intra_epoch_ckpt()
+
+    def on_evaluate_start(self, max_key=None, min_key=None):
+        """Waits for the last checkpoint before loading the best one. The
+        checkpoints are moved by the main process only, so all processes
+        wait for it (DDP barrier) before reading them."""
+        sb.utils.distributed.run_on_main(self.wait_for_checkpoint)
+        super().on_evaluate_start(max_key=max_key, min_key=min_key)
+
 
 def dataio_prep(hparams):
     """This function prepares the datasets to be used in the brain class.
@@ -287,59 +387,93 @@ def dataio_prep(hparams):
         """Load the signal, and pass it and its length to the corruption class.
         This is done on the CPU in the `collate_fn`."""
 
-        audio_tensor = sb.dataio.dataio.read_audio(wav)
-        while (len(audio_tensor) <= snt_len_sample):
-            audio_tensor = audio_tensor.repeat(2)
+        # When the file is long enough, only read the random chunk from disk
+        duration_sample = int(duration * hparams["sample_rate"])
+        if hparams["random_chunk"] and duration_sample > snt_len_sample:
+            start = random.randint(0, duration_sample - snt_len_sample - 1)
+            stop = start + snt_len_sample
+            return sb.dataio.dataio.read_audio(
+                {"file": wav, "start": start, "stop": stop}
+            )
+
+        return chunk_signal(sb.dataio.dataio.read_audio(wav))
+
+    # Audio pipeline reading the signals decoded by `create_memmap`
+    if hparams["use_memmap"]:
+        memmap = np.load(hparams["memmap_file"], mmap_mode="r")
 
-        if sb.Stage.TRAIN and hparams["random_chunk"]:
+    @sb.utils.data_pipeline.takes("offset", "length")
+    @sb.utils.data_pipeline.provides("sig")
+    def memmap_audio_pipeline(offset, length):
+        """Same as `audio_pipeline`, but slices the int16 signal from the
+        memory-mapped array instead of decoding the audio file."""
+
+        # When the signal is long enough, only copy the random chunk
+        if hparams["random_chunk"] and length > snt_len_sample:
+            start = offset + random.randint(0, length - snt_len_sample - 1)
+            return int16_to_float(memmap[start : start + snt_len_sample])
+
+        return chunk_signal(int16_to_float(memmap[offset : offset + length]))
+
+    def int16_to_float(signal):
+        """Converts an int16 numpy signal to a float tensor in [-1, 1]."""
+        return torch.from_numpy(signal.astype(np.float32) / 32768)
+
+    def chunk_signal(audio_tensor):
+        """Repeats the signal if it is too short, and takes its random chunk
+        (if random_chunk is set)."""
+        if len(audio_tensor) <= snt_len_sample:
+            # Smallest repeat count giving more than snt_len_sample samples
+            audio_tensor = audio_tensor.repeat(
+                snt_len_sample // len(audio_tensor) + 1
+            )
+
+        if hparams["random_chunk"]:
             start = random.randint(0, len(audio_tensor) - snt_len_sample - 1)
             stop = start + snt_len_sample
         else:
             start = 0
             stop = len(audio_tensor)
-        sig = audio_tensor[start:stop]
-        
-#        fs, signal = sciwav.read(wav, mmap=True)
-#        if signal.shape[0] <= snt_len_sample:
-#            signal = np.concatenate([signal] * (math.floor(tlen / signal.shape[0]) + 1), axis=0)
-#
-#        if hparams["random_chunk"]:
-#            start = random.randint(0, len(audio_tensor) - snt_len_sample - 1)
-#            stop = start + snt_len_sample
-#            signal = signal[start:stop]
-
-#        sig = copy.deepcopy(np.array(signal))
-#        sig = torch.from_numpy(sig)
-
-        return sig 
+        return audio_tensor[start:stop]
 
     # Define label pipeline:
     @sb.utils.data_pipeline.takes("gender_id")
     @sb.utils.data_pipeline.provides("gender_id", "gender_id_encoded")
     def label_pipeline(gender_id):
         yield gender_id
-        gender_id_encoded = label_encoder.encode_label_torch(gender_id)
+        # A plain int, so that PaddedBatch stacks the labels of the batch in
+        # a single tensor, instead of padding one tensor per example
+        gender_id_encoded = label_encoder.encode_label(gender_id)
         yield gender_id_encoded
 
     # Define datasets. We also connect the dataset with the data processing
-    # functions defined above.
+    # functions defined above. The memory-mapped signals are located by the
+    # manifests written by `create_memmap`.
     datasets = {}
     for dataset in ["train", "valid", "test"]:
+        if hparams["use_memmap"]:
+            json_path = hparams[f"memmap_{dataset}_annotation"]
+        else:
+            json_path = hparams[f"{dataset}_annotation"]
         datasets[dataset] = sb.dataio.dataset.DynamicItemDataset.from_json(
-            json_path=hparams[f"{dataset}_annotation"],
+            json_path=json_path,
             replacements={"data_root": hparams["data_folder"]},
-            dynamic_items=[audio_pipeline, label_pipeline],
+            dynamic_items=[
+                memmap_audio_pipeline
+                if hparams["use_memmap"]
+                else audio_pipeline,
+                label_pipeline,
+            ],
             output_keys=["id", "sig", "gender_id_encoded"],
         )
 
     # Load or compute the label encoder (with multi-GPU DDP support)
     # Please, take a look into the lab_enc_file to see the label to index
-    # mapping.
+    # mapping. The two gender labels of SPEAKERS.TXT are known in advance,
+    # so there is no need to scan the whole training set to collect them.
     lab_enc_file = os.path.join(hparams["save_folder"], "label_encoder.txt")
     label_encoder.load_or_create(
-        path=lab_enc_file,
-        from_didatasets=[datasets["train"]],
-        output_key="gender_id",
+        path=lab_enc_file, from_iterables=[["M", "F"]],
     )
 
     return datasets
@@ -357,6 +491,14 @@ if __name__ == "__main__":
     # Load hyperparameters file with command-line overrides.
     with open(hparams_file) as fin:
         hparams = load_hyperpyyaml(fin, overrides)
+    run_opts["auto_mix_prec"] = hparams["auto_mix_prec"]
+
+    # Cap the number of CPU threads (too many of them slow down training a
+    # lot on many-core CPUs), and let cuDNN benchmark its algorithms unless
+    # reproducible results are requested.
+    torch.set_num_threads(min(16, os.cpu_count() or 1))
+    torch.backends.cudnn.benchmark = not hparams["cudnn_deterministic"]
+    torch.backends.cudnn.deterministic = hparams["cudnn_deterministic"]
 
     # Create experiment directory
     sb.create_experiment_directory(
@@ -365,6 +507,26 @@ if __name__ == "__main__":
         overrides=overrides,
     )
 
+    # Decode the whole corpus once into a memory-mapped array (if requested)
+    if hparams["use_memmap"]:
+        sb.utils.distributed.run_on_main(
+            create_memmap,
+            kwargs={
+                "json_files": [
+                    hparams["train_annotation"],
+                    hparams["valid_annotation"],
+                    hparams["test_annotation"],
+                ],
+                "memmap_json_files": [
+                    hparams["memmap_train_annotation"],
+                    hparams["memmap_valid_annotation"],
+                    hparams["memmap_test_annotation"],
+                ],
+                "memmap_file": hparams["memmap_file"],
+                "data_folder": hparams["data_folder"],
+            },
+        )
+
     # Create dataset objects "train", "valid", and "test".
     datasets = dataio_prep(hparams)
 
@@ -373,6 +535,31 @@ if __name__ == "__main__":
         sb.utils.distributed.run_on_main(hparams["pretrainer"].collect_files)
         hparams["pretrainer"].load_collected(device=run_opts["device"])
 
+    # Batch the training utterances by duration (if requested). The Brain
+    # cannot split a batch sampler between DDP processes, which would then
+    # all train on the same batches.
+    train_loader_kwargs = hparams["dataloader_options"]
+    if hparams["dynamic_batching"] and run_opts["distributed_launch"]:
+        raise ValueError(
+            "dynamic_batching is not supported with distributed_launch"
+        )
+    if hparams["dynamic_batching"]:
+        dynamic_hparams = hparams["dynamic_batch_sampler"]
+        train_sampler = DynamicBatchSampler(
+            datasets["train"],
+            dynamic_hparams["max_batch_len"],
+            dynamic_hparams["left_bucket_len"],
+            bucket_length_multiplier=dynamic_hparams["multiplier"],
+            length_func=lambda x: x["duration"],
+            shuffle=dynamic_hparams["shuffle_ex"],
+        )
+        train_loader_kwargs = {
+            key: value
+            for key, value in hparams["dataloader_options"].items()
+            if key not in ["batch_size", "shuffle"]
+        }
+        train_loader_kwargs["batch_sampler"] = train_sampler
+
     # Initialize the Brain object to prepare for mask training.
     gender_id_brain = SpkIdBrain(
         modules=hparams["modules"],
@@ -382,6 +569,10 @@ if __name__ == "__main__":
         checkpointer=hparams["checkpointer"],
     )
 
+    # Let fit() call set_epoch, so that batches are shuffled at every epoch
+    if hparams["dynamic_batching"]:
+        gender_id_brain.train_sampler = train_sampler
+
     # The `fit()` method iterates the training loop, calling the methods
     # necessary to update the parameters of the model. Since all objects
     # with changing state are managed by the Checkpointer, training can be
@@ -390,7 +581,7 @@ if __name__ == "__main__":
         epoch_counter=gender_id_brain.hparams.epoch_counter,
         train_set=datasets["train"],
         valid_set=datasets["valid"],
-        train_loader_kwargs=hparams["dataloader_options"],
+        train_loader_kwargs=train_loader_kwargs,
         valid_loader_kwargs=hparams["dataloader_options"],
     )
 
@@ -400,3 +591,7 @@ if __name__ == "__main__":
         min_key="error",
         test_loader_kwargs=hparams["dataloader_options"],
     )
+
+    # Surface any error of the last background checkpoint, and stop its thread
+    gender_id_brain.wait_for_checkpoint()
+    gender_id_brain.ckpt_pool.shutdown(wait=True)